@@ -1,3 +1,5 @@
+import os
+import sys
 import time
 import think.think as think
 import think.memory as memory
@@ -8,9 +10,12 @@ import think.memory as memory
 # maybe having it structured like "plan:..." "context: summarized history" and "last few messages: ..." makes more sense?
 
 
+LOG_FORMAT = "\033[0m{}\033[0m\n"
+
+
 def log(message):
     # print with white color
-    print("\033[0m" + str(message) + "\033[0m")
+    sys.stdout.write(LOG_FORMAT.format(message))
 
 
 def write_start_message():
@@ -47,13 +52,24 @@ I am here to help you and will try to contact you as soon as possible!
 Note: I am still in development, so please be patient with me! <3
 
 """
+    # the typing animation takes about 10 seconds, so it only runs when asked for
+    # and someone is actually watching the terminal.
+    if not sys.stdout.isatty() or os.getenv("MINI_AUTOGPT_ANIMATE", "0") != "1":
+        sys.stdout.write(pic + "\n" + message)
+        sys.stdout.flush()
+        return
+
     # write the pic in print line by line with a tiny delay between each line, then add the message below as if someone was typing it.
     for line in pic.split("\n"):
         print(line)
         time.sleep(0.1)
-    for char in message:
-        print(char, end="", flush=True)
-        time.sleep(0.05)
+    # type a few characters per flush, it looks the same but needs far fewer writes.
+    chunk_size = 8
+    for i in range(0, len(message), chunk_size):
+        chunk = message[i : i + chunk_size]
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        time.sleep(0.05 * len(chunk))
 
 
 def start_mini_autogpt():
@@ -0,0 +1,148 @@
+import pytest
+
+tiktoken = pytest.importorskip("tiktoken")
+pytest.importorskip("orjson")
+pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+
+import think.memory as memory
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    # one token per byte, so every multi-byte character is split over several tokens.
+    encoding = tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"""\S+|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    monkeypatch.setattr(memory, "get_encoding", lambda model_name: encoding)
+    return encoding
+
+
+@pytest.mark.parametrize("max_tokens", [1, 2, 7, 3000])
+def test_chunk_text_keeps_non_ascii_characters(byte_encoding, max_tokens):
+    text = "héllo 🎉 wörld 漢字 " * 5
+    chunks = memory.chunk_text(text, max_tokens=max_tokens)
+    assert "".join(chunks) == text
+    assert "�" not in "".join(chunks)
+
+
+def test_chunk_text_respects_max_tokens(byte_encoding):
+    chunks = memory.chunk_text("hello world " * 10, max_tokens=7)
+    assert all(len(byte_encoding.encode(chunk)) <= 7 for chunk in chunks)
+
+
+def test_chunk_text_empty_text(byte_encoding):
+    assert memory.chunk_text("") == [""]
+
+
+def test_damaged_summary_cache_is_treated_as_empty(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "summary_cache.json").write_text('{"abc": "trunc')
+    assert memory.load_summary_cache() == {}
+
+
+def test_save_summary_cache_replaces_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    memory.save_summary_cache({"abc": "summary"})
+    assert memory.load_summary_cache() == {"abc": "summary"}
+    assert not (tmp_path / "summary_cache.json.tmp").exists()
+
+
+def test_load_jsonl_converts_old_json_history(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "conversation_history.json").write_text('["AI: hi", "User: hello"]')
+    assert memory.load_jsonl("conversation_history.jsonl") == ["AI: hi", "User: hello"]
+    assert (tmp_path / "conversation_history.jsonl").read_text() == (
+        '"AI: hi"\n"User: hello"\n'
+    )
+
+
+def test_count_tokens_cached_does_not_keep_the_text(byte_encoding, monkeypatch):
+    monkeypatch.setattr(memory, "token_count_cache", {})
+    text = "héllo " * 100
+    assert memory.count_string_tokens(text) == len(text.encode("utf-8"))
+    assert memory.count_string_tokens(text) == len(text.encode("utf-8"))
+    assert list(memory.token_count_cache) == [(hash(text), len(text), "gpt-3.5-turbo")]
+
+
+def test_load_jsonl_skips_damaged_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "conversation_history.jsonl").write_text('"AI: hi"\n"User: hel')
+    assert memory.load_jsonl("conversation_history.jsonl") == ["AI: hi"]
+
+
+def test_append_after_damaged_line_keeps_new_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "conversation_history.jsonl").write_text('"AI: hi"\n"User: hel')
+    memory.append_jsonl("conversation_history.jsonl", ["User: again"])
+    assert memory.load_jsonl("conversation_history.jsonl") == ["AI: hi", "User: again"]
+
+
+@pytest.fixture
+def fake_summarizer(tmp_path, monkeypatch):
+    """Records every text sent for summarization and counts no summary as too long."""
+    monkeypatch.chdir(tmp_path)
+    sent = []
+
+    def summarize_chunks(chunks):
+        sent.extend(chunks)
+        return [f"S{len(sent)}" for _ in chunks]
+
+    monkeypatch.setattr(memory, "chunk_text", lambda text: [text])
+    monkeypatch.setattr(memory, "summarize_chunks", summarize_chunks)
+    monkeypatch.setattr(memory, "count_string_tokens", lambda text, model_name: 0)
+    return sent
+
+
+def test_summarize_history_only_sends_new_entries(fake_summarizer):
+    history = ["a", "b", "c"]
+    assert memory.summarize_history("test", history, 1000) == "S1"
+    assert fake_summarizer == [str(["a", "b", "c"])]
+
+    history += ["d", "e"]
+    assert memory.summarize_history("test", history, 1000) == "S1 S2"
+    assert fake_summarizer[1:] == [str(["d", "e"])]
+
+
+def test_summarize_history_keeps_recent_entries(fake_summarizer):
+    history = [str(i) for i in range(10)]
+    result = memory.summarize_history("test", history, 1000, keep_recent=6)
+    assert fake_summarizer == [str(history[:4])]
+    assert result == "S1 4 5 6 7 8 9"
+
+
+def test_summarize_history_starts_over_when_history_shrinks(fake_summarizer):
+    memory.summarize_history("test", ["a", "b", "c", "d"], 1000)
+    assert memory.summarize_history("test", ["x", "y"], 1000) == "S2"
+    assert fake_summarizer[1:] == [str(["x", "y"])]
+
+
+def test_summarize_history_compacts_long_summary(fake_summarizer, monkeypatch):
+    monkeypatch.setattr(memory, "count_string_tokens", lambda text, model_name: 100)
+    assert memory.summarize_history("test", ["a", "b"], 1) == "S2"
+    assert fake_summarizer == [str(["a", "b"]), "S1"]
+
+
+def test_summarize_history_without_new_entries_skips_llm(fake_summarizer):
+    history = ["a", "b"]
+    memory.summarize_history("test", history, 1000)
+    assert memory.summarize_history("test", history, 1000) == "S1"
+    assert len(fake_summarizer) == 1
+
+
+def test_is_over_token_limit_only_counts_unclear_sizes(monkeypatch):
+    counted = []
+
+    def count_string_tokens(text, model_name):
+        counted.append(text)
+        return 150
+
+    monkeypatch.setattr(memory, "count_string_tokens", count_string_tokens)
+    assert not memory.is_over_token_limit("x" * 100, 100)
+    assert memory.is_over_token_limit("x" * 801, 100)
+    assert counted == []
+    assert memory.is_over_token_limit("x" * 500, 100)
+    assert counted == ["x" * 500]
@@ -1,35 +1,182 @@
+import atexit
+import codecs
+import concurrent.futures
+import functools
+import hashlib
 import json
+import os
+import sys
+import threading
 import traceback
 
+import orjson
 import tiktoken
 
 import think.prompt as prompt
 import utils.llm as llm
 
 
+LOG_FORMAT = "\033[94m{}\033[0m\n"
+
+
 def log(message):
     # print with purple color
-    print("\033[94m" + str(message) + "\033[0m")
+    sys.stdout.write(LOG_FORMAT.format(message))
+
+
+@functools.lru_cache(maxsize=8)
+def get_encoding(model_name):
+    """Returns the tiktoken encoding for the given model, built only once per model."""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # note: future models may deviate from this
+        return tiktoken.get_encoding("cl100k_base")
+
+
+TOKEN_COUNT_CACHE_SIZE = 64
+
+# keyed on the hash and length of the text, so the histories themselves are not kept alive.
+token_count_cache = {}
+
+
+def count_tokens_cached(text, model_name):
+    """Counts the tokens of a string, repeated calls with the same history are free."""
+    key = (hash(text), len(text), model_name)
+    tokens = token_count_cache.get(key)
+    if tokens is None:
+        tokens = len(get_encoding(model_name).encode(text))
+        token_count_cache[key] = tokens
+        while len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            del token_count_cache[next(iter(token_count_cache))]
+    return tokens
 
 
 def count_string_tokens(text, model_name="gpt-3.5-turbo"):
     """Returns the number of tokens used by a list of messages."""
-    model = model_name
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    # note: future models may deviate from this
+        return count_tokens_cached(text, model_name)
     except Exception as e:
         log(f"Sophie: Error while counting tokens: {e}")
         log(traceback.format_exc())
 
 
-def summarize_text(text, max_new_tokens=100):
+# english text averages about 4 bytes per token, more than 8 is only reached by
+# long runs of whitespace or repeated characters.
+MAX_BYTES_PER_TOKEN = 8
+
+
+def is_over_token_limit(text, limit, model_name="gpt-4"):
+    """
+    Check if text is longer than limit tokens, only running the tokenizer when it is unclear.
+    Every token covers at least one byte, so text of at most limit bytes is always under.
+    Text with more than MAX_BYTES_PER_TOKEN bytes per allowed token is taken as over
+    without counting, if that guess is wrong the text is only summarized a bit early.
+    """
+    size = len(text.encode("utf-8"))
+    if size <= limit:
+        return False
+    if size > limit * MAX_BYTES_PER_TOKEN:
+        return True
+    return count_string_tokens(text, model_name=model_name) > limit
+
+
+def write_file_atomically(path, data):
+    """Write data to a temporary file and move it into place,
+    so an interrupted write never leaves a truncated file behind."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+SUMMARY_CACHE_SIZE = 256
+# how many chunks are summarized at the same time. LMStudio and text-generation-webui
+# generate one answer at a time, set this to 1 if parallel requests cause trouble.
+SUMMARY_WORKERS = 2
+# new summaries are written to disk in batches, the rest is saved at exit.
+SUMMARY_CACHE_SAVE_EVERY = 8
+
+summary_cache = None
+summary_cache_unsaved = 0
+summary_cache_lock = threading.Lock()
+
+
+def load_summary_cache():
+    """Load the summary cache from a file."""
+    try:
+        with open("summary_cache.json", "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except orjson.JSONDecodeError:
+        log("Summary cache is damaged, starting with an empty one.")
+        return {}
+
+
+def save_summary_cache(cache):
+    """Save the summary cache to a file."""
+    write_file_atomically("summary_cache.json", orjson.dumps(cache))
+
+
+def get_summary_cache_key(text, max_new_tokens):
+    """Hash everything that changes the summary: the prompt, the length and the text."""
+    content = f"{prompt.summarize_conversation}\n{max_new_tokens}\n{text}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_cached_summary(key):
+    """Return the cached summary for the given key, or None."""
+    global summary_cache
+    with summary_cache_lock:
+        if summary_cache is None:
+            summary_cache = load_summary_cache()
+        summary = summary_cache.pop(key, None)
+        if summary is not None:
+            # move it to the end, so the least recently used entry is dropped first.
+            summary_cache[key] = summary
+        return summary
+
+
+def cache_summary(key, summary):
+    """Add a summary to the cache, it is saved with the next batch."""
+    global summary_cache, summary_cache_unsaved
+    with summary_cache_lock:
+        if summary_cache is None:
+            summary_cache = load_summary_cache()
+        summary_cache[key] = summary
+        while len(summary_cache) > SUMMARY_CACHE_SIZE:
+            del summary_cache[next(iter(summary_cache))]
+        summary_cache_unsaved += 1
+        if summary_cache_unsaved >= SUMMARY_CACHE_SAVE_EVERY:
+            save_summary_cache(summary_cache)
+            summary_cache_unsaved = 0
+
+
+def flush_summary_cache():
+    """Save summaries that were not written to disk yet."""
+    global summary_cache_unsaved
+    with summary_cache_lock:
+        if summary_cache is not None and summary_cache_unsaved:
+            save_summary_cache(summary_cache)
+            summary_cache_unsaved = 0
+
+
+atexit.register(flush_summary_cache)
+
+
+def summarize_text(text, max_new_tokens=100, use_cache=True):
     """
     Summarize the given text using the given LLM model.
+    Summaries of text that was summarized before are taken from the cache.
     """
+    if use_cache:
+        cache_key = get_summary_cache_key(text, max_new_tokens)
+        cached_summary = get_cached_summary(cache_key)
+        if cached_summary is not None:
+            log("Using cached summary.")
+            return cached_summary
+
     # Define the prompt for the LLM model.
     messages = (
         {
@@ -52,103 +199,150 @@ def summarize_text(text, max_new_tokens=100):
     # Extract the summary from the response.
     summary = response.json()["choices"][0]["message"]["content"]
 
+    if use_cache:
+        cache_summary(cache_key, summary)
     return summary
 
 
 def chunk_text(text, max_tokens=3000):
     """Split a piece of text into chunks of a certain size."""
+    # encode the whole text once and cut the tokens into windows,
+    # instead of re-counting the growing chunk for every word.
+    encoding = get_encoding("gpt-4")
+    tokens = encoding.encode(text)
+    # a character can be split over two tokens, so the windows are decoded to bytes
+    # and the incremental decoder keeps an unfinished character for the next chunk.
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
     chunks = []
-    chunk = ""
-
-    for message in text.split(" "):
-        if (
-            count_string_tokens(str(chunk) + str(message), model_name="gpt-4")
-            <= max_tokens
-        ):
-            chunk += " " + message
-        else:
+    for i in range(0, len(tokens), max_tokens):
+        chunk = decoder.decode(encoding.decode_bytes(tokens[i : i + max_tokens]))
+        if chunk:
             chunks.append(chunk)
-            chunk = message
-    chunks.append(chunk)  # Don't forget the last chunk!
-    return chunks
+    rest = decoder.decode(b"", final=True)
+    if rest:
+        chunks.append(rest)
+    return chunks or [text]
 
 
 def summarize_chunks(chunks):
     """Generate a summary for each chunk of text."""
     summaries = []
     print("Summarizing chunks...")
-    for chunk in chunks:
+    # every chunk is summarized on its own, so send all requests at once.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(len(chunks), SUMMARY_WORKERS))
+    ) as executor:
+        futures = [executor.submit(summarize_text, chunk) for chunk in chunks]
+    for chunk, future in zip(chunks, futures):
         try:
-            summaries.append(summarize_text(chunk))
+            summaries.append(future.result())
         except Exception as e:
             log(f"Error while summarizing text: {e}")
             summaries.append(chunk)  # If summarization fails, use the original text.
     return summaries
 
 
-def get_previous_message_history():
-    """Get the previous message history."""
+def load_history_summaries():
+    """Load the running summaries of the histories from a file."""
     try:
-        if len(conversation_history) == 0:
-            return "There is no previous message history."
+        with open("history_summary.json", "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except orjson.JSONDecodeError:
+        log("History summaries are damaged, summarizing from the start.")
+        return {}
 
-        tokens = count_string_tokens(str(self.conversation_history), model_name="gpt-4")
-        if tokens > 3000:
-            log("Message history is over 3000 tokens. Summarizing...")
-            chunks = chunk_text(str(self.conversation_history))
-            summaries = summarize_chunks(chunks)
-            summarized_history = " ".join(summaries)
-            summarized_history += " " + " ".join(self.conversation_history[-6:])
-            return summarized_history
 
-        return conversation_history
-    except Exception as e:
-        log(f"Error while getting previous message history: {e}")
-        log(traceback.format_exc())
-        exit(1)
+def save_history_summaries(summaries):
+    """Save the running summaries of the histories to a file."""
+    write_file_atomically("history_summary.json", orjson.dumps(summaries))
 
 
-def load_conversation_history(self):
-    """Load the conversation history from a file."""
+def summarize_history(name, history, max_tokens, keep_recent=0):
+    """
+    Summarize a history, keeping the last keep_recent entries as they are.
+    Only entries added since the last call are sent to the LLM, their summary is
+    added to the running summary that is stored in history_summary.json.
+    """
+    summaries = load_history_summaries()
+    state = summaries.get(name, {"summary": "", "last_idx": 0})
+    summary, last_idx = state["summary"], state["last_idx"]
+    if last_idx > len(history):
+        # the history was forgotten since the last summary, start over.
+        summary, last_idx = "", 0
+
+    boundary = max(len(history) - keep_recent, last_idx)
+    if boundary > last_idx:
+        new_summaries = summarize_chunks(chunk_text(str(history[last_idx:boundary])))
+        summary = " ".join([summary] + new_summaries).strip()
+        # keep the running summary itself within the limit.
+        if is_over_token_limit(summary, max_tokens):
+            summary = " ".join(summarize_chunks(chunk_text(summary)))
+        last_idx = boundary
+        summaries[name] = {"summary": summary, "last_idx": last_idx}
+        save_history_summaries(summaries)
+
+    recent = " ".join(str(entry) for entry in history[last_idx:])
+    return (summary + " " + recent).strip()
+
+
+def load_jsonl(path):
+    """Load a list of entries from a json lines file, one entry per line."""
     try:
-        with open("conversation_history.json", "r") as f:
-            self.conversation_history = json.load(f)
+        with open(path, "rb") as f:
+            lines = f.readlines()
     except FileNotFoundError:
-        # If the file doesn't exist, create it.
-        self.conversation_history = []
-    log("Loaded conversation history:")
-    log(self.conversation_history)
-
+        return migrate_json_to_jsonl(path)
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entries.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            # an interrupted append leaves half a line behind, the rest is still fine.
+            log(f"Skipping damaged line in {path}: {line[:80]!r}")
+    return entries
 
-def save_conversation_history(self):
-    """Save the conversation history to a file."""
-    with open("conversation_history.json", "w") as f:
-        json.dump(self.conversation_history, f)
 
+def migrate_json_to_jsonl(path):
+    """Convert the history that older versions stored as one json list, if there is one."""
+    json_path = path.removesuffix(".jsonl") + ".json"
+    try:
+        with open(json_path, "rb") as f:
+            entries = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return []
+    if not isinstance(entries, list):
+        return []
+    log(f"Converting {json_path} to {path}...")
+    save_jsonl(path, entries)
+    return entries
 
-def add_to_conversation_history(self, message):
-    """Add a message to the conversation history and save it."""
-    self.conversation_history.append(message)
-    self.save_conversation_history()
 
+def save_jsonl(path, entries):
+    """Overwrite a json lines file with the given entries."""
+    write_file_atomically(
+        path, b"".join(orjson.dumps(entry) + b"\n" for entry in entries)
+    )
 
-def forget_conversation_history(self):
-    """Forget the conversation history."""
-    self.conversation_history = []
-    self.save_conversation_history()
 
+def append_jsonl(path, entries):
+    """Append entries to a json lines file without rewriting what is already there."""
+    data = b"".join(orjson.dumps(entry) + b"\n" for entry in entries)
+    with open(path, "a+b") as f:
+        # start on a new line if an interrupted append left half a line behind.
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
 
 
 def load_memories():
     """Load the memories from a file."""
-    try:
-        memories = []
-        with open("memories.json", "r") as f:
-            memories = json.load(f)
-        return memories
-    except FileNotFoundError:
-        # If the file doesn't exist, create it.
-        return []
+    return load_jsonl("memories.jsonl")
 
 
 def forget_memory(id):
@@ -162,15 +356,12 @@ def forget_memory(id):
 
 def save_memories(history):
     """Save the memories to a file."""
-    with open("memories.json", "w") as f:
-        json.dump(history, f)
+    save_jsonl("memories.jsonl", history)
 
 
 def save_memory(memory):
     """Save an individual thought string to the history."""
-    memory_history = load_memories()
-    memory_history.append(memory)
-    save_memories(history=memory_history)
+    append_jsonl("memories.jsonl", [memory])
 
 
 def get_response_history():
@@ -180,15 +371,9 @@ def get_response_history():
         if len(response_history) == 0:
             return "There is no previous response history."
 
-        # Assuming a similar function exists for counting tokens and summarizing
-        tokens = count_string_tokens(str(response_history), model_name="gpt-4")
-        if tokens > 500:
+        if is_over_token_limit(str(response_history), 500):
             log("Response history is over 500 tokens. Summarizing...")
-            chunks = chunk_text(str(response_history))
-            summaries = summarize_chunks(chunks)
-            summarized_history = " ".join(summaries)
-            # summarized_history += " " + " ".join(response_history[-6:])
-            return summarized_history
+            return summarize_history("response_history", response_history, 500)
 
         return response_history
     except Exception as e:
@@ -199,26 +384,19 @@ def get_response_history():
 
 def load_response_history():
     """Load the response history from a file."""
-    try:
-        with open("response_history.json", "r") as f:
-            response_history = json.load(f)
-        return response_history
-    except FileNotFoundError:
-        # If the file doesn't exist, create it with an empty list.
-        return []
+    return load_jsonl("response_history.jsonl")
 
 
 def save_response_history(history):
     """Save the response history to a file."""
-    with open("response_history.json", "w") as f:
-        json.dump(history, f)
+    save_jsonl("response_history.jsonl", history)
 
 
 def add_to_response_history(question, response):
     """Add a question and its corresponding response to the history."""
-    response_history = load_response_history()
-    response_history.append({"question": question, "response": response})
-    save_response_history(response_history)
+    append_jsonl(
+        "response_history.jsonl", [{"question": question, "response": response}]
+    )
 
 
 def get_previous_thought_history():
@@ -228,14 +406,11 @@ def get_previous_thought_history():
         if len(thought_history) == 0:
             return "There is no previous message history."
 
-        tokens = memory.count_string_tokens(str(thought_history), model_name="gpt-4")
-        if tokens > 200:
+        if is_over_token_limit(str(thought_history), 200):
             log("Message history is over 3000 tokens. Summarizing...")
-            chunks = memory.chunk_text(str(thought_history))
-            summaries = memory.summarize_chunks(chunks)
-            summarized_history = " ".join(summaries)
-            summarized_history += " " + " ".join(thought_history[-6:])
-            return summarized_history
+            return summarize_history(
+                "thought_history", thought_history, 200, keep_recent=6
+            )
 
         return thought_history
     except Exception as e:
@@ -246,20 +421,12 @@ def get_previous_thought_history():
 
 def load_thought_history():
     """Load the thought history from a file."""
-    try:
-        thoughts = []
-        with open("thought_history.json", "r") as f:
-            thoughts = json.load(f)
-        return thoughts
-    except FileNotFoundError:
-        # If the file doesn't exist, create it.
-        return []
+    return load_jsonl("thought_history.jsonl")
 
 
 def save_thought_history(history):
     """Save the thought history to a file."""
-    with open("thought_history.json", "w") as f:
-        json.dump(history, f)
+    save_jsonl("thought_history.jsonl", history)
 
 
 class Thought:
@@ -274,14 +441,13 @@ class Thought:
 
 def save_thought(thought, context=None):
     """Save an individual thought string to the history."""
-    history = load_thought_history()
     log("Summarizing thought to memory...")
-    summary = summarize_text(thought)
+    # every thought is new, caching its summary would only push out useful entries.
+    summary = summarize_text(thought, use_cache=False)
 
     new_thought = Thought(thought, context, summary).toJSON()
 
-    history.append(new_thought)
-    save_thought_history(history=history)
+    append_jsonl("thought_history.jsonl", [new_thought])
 
 
 def forget_everything():
@@ -291,4 +457,5 @@ def forget_everything():
     save_thought_history(history=[])
     save_response_history(history=[])
     save_memories(history=[])
+    save_history_summaries({})
     print("My memory is empty now, I am ready to learn new things! \n")
@@ -1,9 +1,21 @@
+import threading
 import requests
 from utils.log import log
 import think.memory as memory
 import os
 from dotenv import load_dotenv
 
+# reuse a connection pool for the calls to the local llm server, so every request
+# doesn't pay for a new tcp handshake. requests sessions are not guaranteed to be
+# thread-safe and summaries are sent from worker threads, so each thread gets its own.
+sessions = threading.local()
+
+
+def get_session():
+    if not hasattr(sessions, "session"):
+        sessions.session = requests.Session()
+    return sessions.session
+
 
 def one_shot_request(prompt, system_context):
     history = []
@@ -44,7 +56,7 @@ def send(data):
     headers = {"Content-Type": "application/json"}
 
     try:
-        response = requests.post(api_url, headers=headers, json=data)
+        response = get_session().post(api_url, headers=headers, json=data)
         return response
     except Exception as e:
         log("Exception when talking to API:")
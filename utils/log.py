@@ -1,9 +1,13 @@
 import json
+import sys
+
+
+LOG_FORMAT = "\033[0m{}\033[0m\n"
 
 
 def log(message):
     # print with white color
-    print("\033[0m" + str(message) + "\033[0m")
+    sys.stdout.write(LOG_FORMAT.format(message))
 
 
 def save_debug(data, response):
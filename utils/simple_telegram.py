@@ -1,7 +1,9 @@
 import asyncio
-import json
+import atexit
 import os
 import random
+import sys
+import time
 import traceback
 from telegram import Bot, Update
 from telegram.error import TimedOut
@@ -11,6 +13,36 @@ import think.memory as memory
 
 response_queue = ""
 
+# messages are written to the conversation history file in batches,
+# a new TelegramUtils is created for every action so the buffer lives here.
+# the age of the batch is only checked when a message is added and while waiting
+# for telegram updates, between those the rest is written at exit.
+CONVERSATION_FLUSH_SIZE = 8
+CONVERSATION_FLUSH_SECONDS = 30
+pending_conversation_history = []
+last_conversation_flush = time.monotonic()
+
+
+def flush_conversation_history():
+    """Write the pending conversation messages to the history file."""
+    global last_conversation_flush
+    if pending_conversation_history:
+        memory.append_jsonl("conversation_history.jsonl", pending_conversation_history)
+        pending_conversation_history.clear()
+    last_conversation_flush = time.monotonic()
+
+
+def flush_conversation_history_if_due():
+    """Write the pending messages if the batch is full or old enough."""
+    if (
+        len(pending_conversation_history) >= CONVERSATION_FLUSH_SIZE
+        or time.monotonic() - last_conversation_flush >= CONVERSATION_FLUSH_SECONDS
+    ):
+        flush_conversation_history()
+
+
+atexit.register(flush_conversation_history)
+
 
 def run_async(coro):
     try:
@@ -25,9 +57,12 @@ def run_async(coro):
         return asyncio.run(coro)
 
 
+LOG_FORMAT = "\033[95m{}\033[0m\n"
+
+
 def log(message):
     # print with purple color
-    print("\033[95m" + str(message) + "\033[0m")
+    sys.stdout.write(LOG_FORMAT.format(message))
 
 
 class TelegramUtils:
@@ -85,15 +120,11 @@ class TelegramUtils:
             if len(self.conversation_history) == 0:
                 return "There is no previous message history."
 
-            tokens = memory.count_string_tokens(
-                str(self.conversation_history), model_name="gpt-4"
-            )
-            if tokens > 1000:
+            if memory.is_over_token_limit(str(self.conversation_history), 1000):
                 log("Message history is over 1000 tokens. Summarizing...")
-                chunks = memory.chunk_text(str(self.conversation_history))
-                summaries = memory.summarize_chunks(chunks)
-                summarized_history = " ".join(summaries)
-                return summarized_history
+                return memory.summarize_history(
+                    "conversation_history", self.conversation_history, 1000
+                )
 
             return self.conversation_history
         except Exception as e:
@@ -103,22 +134,19 @@ class TelegramUtils:
 
     def load_conversation_history(self):
         """Load the conversation history from a file."""
-        try:
-            with open("conversation_history.json", "r") as f:
-                self.conversation_history = json.load(f)
-        except FileNotFoundError:
-            # If the file doesn't exist, create it.
-            self.conversation_history = []
+        flush_conversation_history()
+        self.conversation_history = memory.load_jsonl("conversation_history.jsonl")
 
     def save_conversation_history(self):
         """Save the conversation history to a file."""
-        with open("conversation_history.json", "w") as f:
-            json.dump(self.conversation_history, f)
+        memory.save_jsonl("conversation_history.jsonl", self.conversation_history)
+        pending_conversation_history.clear()
 
     def add_to_conversation_history(self, message):
-        """Add a message to the conversation history and save it."""
+        """Add a message to the conversation history, it is saved with the next batch."""
         self.conversation_history.append(message)
-        self.save_conversation_history()
+        pending_conversation_history.append(message)
+        flush_conversation_history_if_due()
 
     def poll_anyMessage(self):
         print("Waiting for first message...")
@@ -254,6 +282,7 @@ class TelegramUtils:
         log("last update id: " + str(last_update_id))
         log("Waiting for new messages...")
         while True:
+            flush_conversation_history_if_due()
             try:
                 updates = await bot.get_updates(offset=last_update_id + 1, timeout=30)
                 for update in updates: